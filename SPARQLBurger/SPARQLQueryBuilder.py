@@ -8,32 +8,205 @@ Powered by Catalink Ltd (http://catalink.eu)
 """
 
 
+import functools
+
 from SPARQLBurger.SPARQLSyntaxTerms import *
 
 
+# Indentation strings by depth, extended on demand by _indent()
+_INDENTS = ["   " * depth for depth in range(32)]
+
+
+def _indent(depth):
+    """
+    Returns the indentation string for the given depth.
+    :param depth: <int> The indentation depth.
+    :return: <str> The indentation string.
+    """
+    while depth >= len(_INDENTS):
+        _INDENTS.append("   " * len(_INDENTS))
+    return _INDENTS[depth]
+
+
+# Prefixes and namespaces added by SPARQLQuery.add_popular_prefixes()
+_POPULAR_PREFIXES = (
+    ("rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#"),
+    ("rdfs", "http://www.w3.org/2000/01/rdf-schema#"),
+    ("xml", "http://www.w3.org/2001/XMLSchema#"),
+    ("owl", "http://www.w3.org/2002/07/owl#"),
+    ("prov", "http://www.w3.org/ns/prov#"),
+    ("foaf", "http://xmlns.com/foaf/0.1/")
+)
+
+
+class _StreamParts:
+    __slots__ = ("_write", "_last")
+
+    def __init__(self, stream):
+        """
+        A list-like collector of text parts that writes them to a stream instead of keeping them. The latest part is
+        held back until the next one arrives, so that it can still be replaced (e.g. to drop a trailing newline).
+        :param stream: <obj> A text stream or any other object with a write() method.
+        """
+        self._write = stream.write
+        self._last = None
+
+    def append(self, part):
+        """
+        Writes the held back text part to the stream and holds back the given one instead.
+        :param part: <str> The text part to add.
+        """
+        if self._last is not None:
+            self._write(self._last)
+        self._last = part
+
+    def extend(self, parts):
+        """
+        Adds several text parts, as if each one was appended.
+        :param parts: <list> The text parts to add.
+        """
+        for part in parts:
+            self.append(part)
+
+    def __getitem__(self, index):
+        """
+        Returns the held back text part. Only index -1 is supported, since all earlier parts have already been
+        written, which is enough for _emit() to drop the trailing newline of the closing brace part.
+        :param index: <int> The index of the text part, which must be -1.
+        :return: <str> The held back text part.
+        """
+        if index != -1:
+            raise IndexError("Only the last text part can be accessed")
+        return self._last
+
+    def __setitem__(self, index, part):
+        """
+        Replaces the held back text part before it is written. Only index -1 is supported, as in __getitem__().
+        :param index: <int> The index of the text part, which must be -1.
+        :param part: <str> The text part to hold back instead.
+        """
+        if index != -1:
+            raise IndexError("Only the last text part can be replaced")
+        self._last = part
+
+    def flush(self):
+        """
+        Writes the held back text part to the stream.
+        """
+        if self._last is not None:
+            self._write(self._last)
+            self._last = None
+
+
 class SPARQLGraphPattern:
-    def __init__(self, optional=False, union=False):
+    __slots__ = ("_is_optional", "_is_union", "graph", "filters", "bindings", "values", "_dedupe", "_optimize",
+                 "_opening", "_opening_depth", "_render", "_render_depth", "_render_lengths")
+
+    def __init__(self, optional=False, union=False, dedupe=False, optimize=False):
         """
         The SPARQLGraphPattern class constructor.
         :param optional: <bool> Indicates if graph pattern should be marked as OPTIONAL.
         :param union: <bool> Indicates if graph pattern should have a UNION clause that associates it with the previous.
         graph pattern
+        :param dedupe: <bool> Indicates if triples that are already in the graph pattern should be skipped when added
+        again, comparing their text with that of the triples in the graph pattern at the time. Nested graph patterns
+        are always added, since a repeated one may be an operand of a UNION. Defaults at False.
+        :param optimize: <bool> Indicates if the text should be generated from a canonicalized copy of the graph pattern
+        (see canonicalize()), which is made again every time the text is generated. This also applies when the graph
+        pattern is nested in one that is not optimized. Defaults at False.
         """
-        self.is_optional = optional
-        self.is_union = union
+        self._is_optional = optional
+        self._is_union = union
         self.graph = []
         self.filters = []
         self.bindings = []
         self.values = []
 
+        # Whether add_triples() skips triples that are already in graph
+        self._dedupe = dedupe
+
+        # Whether the text is generated from a copy made by canonicalize()
+        self._optimize = optimize
+
+        # Opening text (e.g. "OPTIONAL {") generated for the depth the graph pattern was last rendered at
+        self._opening = None
+        self._opening_depth = None
+
+        # Renderer generated by compile_renderer(), dropped whenever an entry is added, and the lengths of graph,
+        # filters, bindings and values it was generated for, so that entries added to them directly drop it too
+        self._render = None
+        self._render_depth = 0
+        self._render_lengths = None
+
+    def __getstate__(self):
+        """
+        Provides the state of the graph pattern for copying and pickling, without the compiled renderer, since the
+        generated function cannot be pickled. compile_renderer() has to be called again on the copy.
+        :return: <dict> The attributes of the graph pattern by name.
+        """
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["_render"] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores the state of the graph pattern when copying and unpickling.
+        :param state: <dict> The attributes of the graph pattern by name.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def is_optional(self):
+        """
+        Indicates if graph pattern is marked as OPTIONAL.
+        :return: <bool> True if graph pattern is OPTIONAL.
+        """
+        return self._is_optional
+
+    @is_optional.setter
+    def is_optional(self, optional):
+        self._is_optional = optional
+        self._opening_depth = None
+        self._render = None
+
+    @property
+    def is_union(self):
+        """
+        Indicates if graph pattern has a UNION clause that associates it with the previous graph pattern.
+        :return: <bool> True if graph pattern has a UNION clause.
+        """
+        return self._is_union
+
+    @is_union.setter
+    def is_union(self, union):
+        self._is_union = union
+        self._opening_depth = None
+        self._render = None
+
     def add_triples(self, triples):
         """
         Adds a list of triples to the graph pattern.
         :param triples: <list> A list of SPARQLSyntaxTerms.Triple objects.
         :return: <bool> True if addition succeeded, False if given argument was not a list of Triple objects.
+        The list elements are only checked when Python runs without optimizations (i.e. without -O).
         """
-        if type(triples) is list and all(isinstance(element, Triple) for element in triples):
-            self.graph.extend(triples)
+        if type(triples) is list and (not __debug__ or all(isinstance(element, Triple) for element in triples)):
+            if not self._dedupe:
+                self.graph.extend(triples)
+            else:
+                # Triples are compared by their current text, since their attributes and graph may have changed since
+                # they were added
+                triple_texts = {entry.get_text() for entry in self.graph if type(entry) is Triple}
+                for entry in triples:
+                    if type(entry) is Triple:
+                        triple_text = entry.get_text()
+                        if triple_text in triple_texts:
+                            continue
+                        triple_texts.add(triple_text)
+                    self.graph.append(entry)
+
+            self._render = None
             return True
         else:
             return False
@@ -46,6 +219,7 @@ class SPARQLGraphPattern:
         """
         if type(graph_pattern) is SPARQLGraphPattern:
             self.graph.append(graph_pattern)
+            self._render = None
             return True
         else:
             return False
@@ -58,6 +232,7 @@ class SPARQLGraphPattern:
         """
         if type(select_query) is SPARQLSelectQuery:
             self.graph.append(select_query)
+            self._render = None
             return True
         else:
             return False
@@ -70,6 +245,7 @@ class SPARQLGraphPattern:
         """
         if type(filter) is Filter:
             self.filters.append(filter)
+            self._render = None
             return True
         else:
             return False
@@ -82,6 +258,7 @@ class SPARQLGraphPattern:
         """
         if type(filter) is Having:
             self.filters.append(filter)
+            self._render = None
             return True
         else:
             return False
@@ -94,6 +271,7 @@ class SPARQLGraphPattern:
         """
         if type(binding) is Binding:
             self.bindings.append(binding)
+            self._render = None
             return True
         else:
             return False
@@ -106,78 +284,207 @@ class SPARQLGraphPattern:
         """
         if isinstance(value, Values):
             self.values.append(value)
+            self._render = None
             return True
         else:
             return False
 
-    def get_text(self, indentation_depth=0):
+    def get_text(self, indentation_depth=0, trailing_newline=True):
         """
         Generates the text for the SPARQL graph pattern.
         :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
-        :return: <str> The SPARQL graph pattern text. Returns empty string if an exception was raised.
-        """
-        try:
-            # Calculate indentations
-            outer_indentation = indentation_depth * "   "
-            inner_indentation = (indentation_depth + 1) * "   "
-
-            # Initialize string
-            if self.is_optional:
-                query_text = "%sOPTIONAL {\n" % (outer_indentation, )
-            elif self.is_union:
-                query_text = "%sUNION\n%s{\n" % (outer_indentation, outer_indentation)
-            else:
-                query_text = "%s{\n" % (outer_indentation, )
+        :param trailing_newline: <bool> Indicates if the text should end with a newline after the closing brace.
+        Defaults at True.
+        :return: <str> The SPARQL graph pattern text.
+        """
+        render = self._get_render(indentation_depth)
+        if render is not None:
+            return render("\n" if trailing_newline else "")
 
-            for value in self.values:
-                query_text += "%s%s\n" % (inner_indentation, value.get_text())
+        parts = []
+        self._emit(parts, indentation_depth, trailing_newline)
 
-            # Add triples
-            for entry in self.graph:
-                # If entry is a Triple object
-                if type(entry) is Triple:
-                    query_text += "%s%s" % (inner_indentation, entry.get_text())
+        return "".join(parts)
 
-                # If entry is a nested SPARQLGraphPattern object
-                elif type(entry) is SPARQLGraphPattern:
+    def write_to(self, stream, indentation_depth=0, trailing_newline=True):
+        """
+        Writes the text for the SPARQL graph pattern to a stream part by part, without generating the whole text first.
+        :param stream: <obj> A text stream (e.g. a file) or any other object with a write() method.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        :param trailing_newline: <bool> Indicates if the text should end with a newline after the closing brace.
+        Defaults at True.
+        """
+        parts = _StreamParts(stream)
+        self._emit(parts, indentation_depth, trailing_newline)
+        parts.flush()
 
-                    # Get text for nested graph pattern
-                    nested_graph_text = entry.get_text(indentation_depth=indentation_depth + 1)
+    def _emit(self, parts, indentation_depth=0, trailing_newline=True):
+        """
+        Appends the text parts of the SPARQL graph pattern to a list, so that enclosing queries can join all their
+        text at once.
+        :param parts: <list> The list of text parts to append to.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        :param trailing_newline: <bool> Indicates if the text should end with a newline after the closing brace.
+        Defaults at True.
+        """
+        render = self._get_render(indentation_depth)
+        if render is not None:
+            parts.append(render("\n" if trailing_newline else ""))
+            return
+
+        if self._optimize:
+            self.canonicalize()._emit(parts, indentation_depth, trailing_newline)
+            return
 
-                    # Append nested text to graph text
-                    if nested_graph_text:
-                        query_text += nested_graph_text
-                    else:
-                        return False
+        _walk_graph_pattern(self, indentation_depth, parts, _emit_open, _emit_close, _fmt_triples, _ENTRY_HANDLERS)
 
-                # If entry is a nested SPARQLSelectQuery object
+        # Drop the newline from the closing brace part only, instead of slicing the whole text
+        if not trailing_newline:
+            parts[-1] = parts[-1][:-1]
+
+    def canonicalize(self):
+        """
+        Makes a copy of the graph pattern and all graph patterns nested in it in a shorter, equivalent form:
+        nested graph patterns with the same text as an earlier one are removed, and multiple FILTER expressions of a
+        graph pattern are merged into a single one that joins them with &&. The graph patterns themselves are left
+        unchanged, and the copies share their terms.
+        A nested graph pattern is only removed if both it and the earlier one are joined with the rest of the graph
+        pattern, i.e. neither of them nor the graph pattern following either of them is a UNION, since dropping a
+        UNION operand changes which solutions are returned. Removing a repeated joined graph pattern may still change
+        the number of times a solution is returned, so this is meant for queries where only distinct solutions matter.
+        Nested graph patterns are compared by their structure, which is worked out bottom-up along with the copies, so
+        the whole canonicalization takes a single pass over the graph patterns.
+        :return: <obj> The canonicalized SPARQLGraphPattern copy.
+        """
+        # Collect all graph patterns, so that nested ones can be copied before the patterns holding them
+        graph_patterns = []
+        stack = [self]
+        while stack:
+            graph_pattern = stack.pop()
+            graph_patterns.append(graph_pattern)
+            stack.extend(entry for entry in graph_pattern.graph if type(entry) is SPARQLGraphPattern)
+
+        # Copies by the id of the graph pattern they were made from, so that a graph pattern nested twice is copied once
+        copies = {}
+
+        # Numbers of the structures of the copies by the id of the graph pattern they were made from, and the numbers
+        # handed out by structure. A structure is a flat tuple that refers to nested copies by their numbers, so
+        # comparing two of them does not go through the nested graph patterns again.
+        copy_structures = {}
+        structure_numbers = {}
+
+        for graph_pattern in reversed(graph_patterns):
+            if id(graph_pattern) in copies:
+                continue
+
+            canonical_pattern = SPARQLGraphPattern(optional=graph_pattern._is_optional, union=graph_pattern._is_union)
+            entries = [
+                copies[id(entry)] if type(entry) is SPARQLGraphPattern else entry for entry in graph_pattern.graph
+            ]
+
+            # Drop joined nested graph patterns that repeat an earlier joined one
+            nested_structures = set()
+            entry_keys = []
+            for index, entry in enumerate(entries):
+                if type(entry) is SPARQLGraphPattern:
+                    entry_key = copy_structures[id(graph_pattern.graph[index])]
+                    if _is_joined(entries, index):
+                        if entry_key in nested_structures:
+                            continue
+                        nested_structures.add(entry_key)
+                elif type(entry) is Triple:
+                    entry_key = entry.get_text()
                 elif type(entry) is SPARQLSelectQuery:
+                    entry_key = (entry.get_text(),)
+                else:
+                    entry_key = None
+                entry_keys.append(entry_key)
+                canonical_pattern.graph.append(entry)
+
+            # Merge the FILTER expressions in place of the first one, keeping any HAVING expressions
+            canonical_pattern.filters = list(graph_pattern.filters)
+            filters = [entry for entry in graph_pattern.filters if type(entry) is Filter]
+            if len(filters) > 1:
+                merged_filter = Filter(expression="(" + ") && (".join([entry.expression for entry in filters]) + ")")
+                first_index = graph_pattern.filters.index(filters[0])
+                canonical_pattern.filters = [entry for entry in graph_pattern.filters if type(entry) is not Filter]
+                canonical_pattern.filters.insert(first_index, merged_filter)
+
+            canonical_pattern.bindings = list(graph_pattern.bindings)
+            canonical_pattern.values = list(graph_pattern.values)
+            copies[id(graph_pattern)] = canonical_pattern
+
+            structure = (
+                canonical_pattern._is_optional,
+                canonical_pattern._is_union,
+                tuple(entry_keys),
+                tuple([entry.get_text() for entry in canonical_pattern.filters]),
+                tuple([entry.get_text() for entry in canonical_pattern.bindings]),
+                tuple([entry.get_text() for entry in canonical_pattern.values])
+            )
+            copy_structures[id(graph_pattern)] = structure_numbers.setdefault(structure, len(structure_numbers))
 
-                    # Get the text for the nested select query
-                    nested_select_text = entry.get_text(indentation_depth=indentation_depth + 2)
+        return copies[id(self)]
 
-                    # Append nested text to graph text
-                    if nested_select_text:
-                        query_text += "%s{%s%s}\n" % (inner_indentation, nested_select_text, inner_indentation)
-                    else:
-                        return False
+    def _get_render(self, indentation_depth):
+        """
+        Returns the renderer generated by compile_renderer() if it was generated for the given indentation depth and
+        the lists of the graph pattern still have the lengths it was generated for. Otherwise the renderer is dropped.
+        :param indentation_depth: <int> The indentation depth the text is generated for.
+        :return: <function> The renderer, or None if there is none to use.
+        """
+        if self._render is None or indentation_depth != self._render_depth:
+            return None
+
+        if self._render_lengths != (len(self.graph), len(self.filters), len(self.bindings), len(self.values)):
+            self._render = None
+            return None
+        return self._render
+
+    def _get_opening(self, indentation_depth):
+        """
+        Generates the opening text of the graph pattern (e.g. "OPTIONAL {") and keeps it for later calls.
+        :param indentation_depth: <int> The indentation depth of the graph pattern.
+        :return: <str> The opening text.
+        """
+        outer_indentation = _indent(indentation_depth)
+
+        if self._is_optional:
+            self._opening = f"{outer_indentation}OPTIONAL {{\n"
+        elif self._is_union:
+            self._opening = f"{outer_indentation}UNION\n{outer_indentation}{{\n"
+        else:
+            self._opening = f"{outer_indentation}{{\n"
+        self._opening_depth = indentation_depth
 
-            # Add binding texts
-            for binding in self.bindings:
-                query_text += "%s%s\n" % (inner_indentation, binding.get_text())
+        return self._opening
 
-            # Add filter texts
-            for filter in self.filters:
-                query_text += "%s%s\n" % (inner_indentation, filter.get_text())
+    def compile_renderer(self, indentation_depth=0):
+        """
+        Generates a Python function specialized for the current structure of the graph pattern (including its
+        nested graph patterns), which get_text() then uses for the given indentation depth. The function only
+        joins constant text with the text of the contained terms, skipping the walk over the structure, so changes
+        to the terms themselves are included.
+        The function is dropped when an entry is added through the add_*() methods or the lengths of the graph,
+        filters, bindings or values lists of this graph pattern change. Entries replaced in these lists (e.g.
+        graph[0] = ...) and any changes to nested graph patterns are not noticed, so compile_renderer() has to be
+        called again after them.
+        :param indentation_depth: <int> The indentation depth the function will be used for. Defaults at 0.
+        """
+        graph_pattern = self.canonicalize() if self._optimize else self
 
-            # Finalize graph text
-            query_text += "%s}\n" % (outer_indentation, )
+        parts = []
+        _walk_graph_pattern(
+            graph_pattern, indentation_depth, parts, _compile_open, _compile_close, _compile_triples, _COMPILE_HANDLERS
+        )
 
-            return query_text
+        # Let the function take the line ending after the closing brace as an argument
+        parts[-1] = parts[-1][:-1]
+        parts.append((None, "end"))
 
-        except Exception as e:
-            print("Error 1 @ SPARQLGraphPattern.get_text()", e)
-            return ""
+        self._render = _compile_parts(parts, arguments="end")
+        self._render_depth = indentation_depth
+        self._render_lengths = (len(self.graph), len(self.filters), len(self.bindings), len(self.values))
 
 
 class SPARQLQuery:
@@ -189,6 +496,10 @@ class SPARQLQuery:
         self.prefixes = []
         self.where = None
 
+        # PREFIX block text, kept along with the texts of the prefixes it was generated from
+        self._prefixes_key = None
+        self._prefixes_text = None
+
         if include_popular_prefixes:
             self.add_popular_prefixes()
 
@@ -205,22 +516,11 @@ class SPARQLQuery:
             return False
 
     def add_popular_prefixes(self):
-        popular_prefixes = {
-            "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
-            "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
-            "xml": "http://www.w3.org/2001/XMLSchema#",
-            "owl": "http://www.w3.org/2002/07/owl#",
-            "prov": "http://www.w3.org/ns/prov#",
-            "foaf": "http://xmlns.com/foaf/0.1/"
-        }
-
-        for prefix in popular_prefixes:
-            self.add_prefix(
-                prefix=Prefix(
-                    prefix=prefix,
-                    namespace=popular_prefixes[prefix]
-                )
-            )
+        """
+        Adds the PREFIX expressions of some popular namespaces (e.g. rdf, rdfs, owl) to the query.
+        """
+        # Each query gets its own Prefix objects, since their attributes may be changed
+        self.prefixes.extend([Prefix(prefix=prefix, namespace=namespace) for prefix, namespace in _POPULAR_PREFIXES])
 
     def set_where_pattern(self, graph_pattern):
         """
@@ -234,6 +534,21 @@ class SPARQLQuery:
         else:
             return False
 
+    def _get_prefixes_text(self):
+        """
+        Generates the text for the PREFIX expressions of the query, sorted by prefix so that queries with the same
+        prefixes share the same PREFIX block. The sorted text is kept until the texts of the prefixes change, which
+        also catches changes made directly to the prefixes list.
+        :return: <str> The PREFIX block text.
+        """
+        prefix_texts = [prefix.get_text() for prefix in self.prefixes]
+
+        if prefix_texts != self._prefixes_key:
+            sorted_prefixes = sorted(self.prefixes, key=lambda prefix: prefix.prefix)
+            self._prefixes_text = "".join([prefix.get_text() for prefix in sorted_prefixes])
+            self._prefixes_key = prefix_texts
+        return self._prefixes_text
+
 
 class SPARQLSelectQuery(SPARQLQuery):
     def __init__(self, distinct=False, limit=False, include_popular_prefixes=False):
@@ -254,8 +569,9 @@ class SPARQLSelectQuery(SPARQLQuery):
         Adds a list of variables to be selected by the select query
         :param variables: <list> A list of variables as strings.
         :return: <bool> True if addition succeeded, False if given argument was not a list of strings.
+        The list elements are only checked when Python runs without optimizations (i.e. without -O).
         """
-        if type(variables) is list and all(isinstance(element, str) for element in variables):
+        if type(variables) is list and (not __debug__ or all(isinstance(element, str) for element in variables)):
             self.variables.extend(variables)
             return True
         else:
@@ -277,54 +593,112 @@ class SPARQLSelectQuery(SPARQLQuery):
         """
         Generates the text for the SPARQL select query.
         :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
-        :return: <str> The SPARQL Select query text. Returns empty string if an exception was raised.
+        :return: <str> The SPARQL Select query text.
         """
-        try:
-            # Calculate indentation
-            outer_indentation = indentation_depth * "   "
+        parts = []
+        self._emit(parts, indentation_depth)
 
-            # Initialize text string
-            query_text = ""
+        return "".join(parts)
 
-            # Add prefixes
-            for prefix in self.prefixes:
-                query_text += prefix.get_text()
+    def write_to(self, stream, indentation_depth=0):
+        """
+        Writes the text for the SPARQL select query to a stream part by part, without generating the whole text first.
+        :param stream: <obj> A text stream (e.g. a file) or any other object with a write() method.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        """
+        parts = _StreamParts(stream)
+        self._emit(parts, indentation_depth)
+        parts.flush()
 
-            # Add SELECT token
-            if self.distinct:
-                distinct_token = "DISTINCT "
-            else:
-                distinct_token = ""
-            query_text += "\n%sSELECT %s" % (outer_indentation, distinct_token)
+    def compile(self, indentation_depth=0):
+        """
+        Generates a Python function specialized for the current structure of the select query, for generating many
+        queries that only differ in the values of their VALUES expressions. The function takes a dict from VALUES
+        variable names (e.g. "?friend") to lists of values and returns the query text, using the values given in the
+        query for any variable missing from the dict. VALUES expressions of nested select queries are not replaced.
+        The function does not follow later changes to the query structure.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        :return: <function> The function that generates the query text.
+        """
+        parts = []
+        self._emit_head(parts, indentation_depth)
 
-            # If some variables have been defined, add them
-            if self.variables:
-                query_text += " ".join(self.variables)
+        if self.where is not None:
+            where = self.where.canonicalize() if self.where._optimize else self.where
 
-            # If no variable has been defined, use *
-            else:
-                query_text += " *"
+            compile_open = functools.partial(_compile_open, values_call="_values_text({}, values)")
+            _walk_graph_pattern(
+                where, indentation_depth, parts, compile_open, _compile_close, _compile_triples, _COMPILE_HANDLERS
+            )
+            parts[-1] = parts[-1][:-1]
 
-            # Add WHERE token
-            query_text += "\n%sWHERE " % (outer_indentation, )
+        self._emit_tail(parts, indentation_depth)
 
-            # Add WHERE pattern graph
-            if self.where is not None:
-                query_text += self.where.get_text(indentation_depth=indentation_depth)[:-1]
+        return _compile_parts(parts, arguments="values=None")
 
-            # Add group by expressions
-            for group in self.group_by:
-                query_text += "\n%s%s" % (outer_indentation, group.get_text())
+    def _emit(self, parts, indentation_depth=0):
+        """
+        Appends the text parts of the SPARQL select query to a list.
+        :param parts: <list> The list of text parts to append to.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        """
+        self._emit_head(parts, indentation_depth)
 
-            # Add limit if required
-            if self.limit:
-                query_text += "\nLIMIT %s" % (str(self.limit))
+        # Add WHERE pattern graph
+        if self.where is not None:
+            self.where._emit(parts, indentation_depth, trailing_newline=False)
 
-            return query_text
+        self._emit_tail(parts, indentation_depth)
 
-        except Exception as e:
-            print("Error 1 @ SPARQLSelectQuery.get_text()", e)
-            return ""
+    def _emit_head(self, parts, indentation_depth):
+        """
+        Appends the text parts of the SPARQL select query up to the WHERE token to a list.
+        :param parts: <list> The list of text parts to append to.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text.
+        """
+        # Calculate indentation
+        outer_indentation = _indent(indentation_depth)
+
+        # Add the prefixes block
+        parts.append(self._get_prefixes_text())
+
+        # Add SELECT token
+        if self.distinct:
+            distinct_token = "DISTINCT "
+        else:
+            distinct_token = ""
+        parts.append(f"\n{outer_indentation}SELECT {distinct_token}")
+
+        # If some variables have been defined, add them
+        if self.variables:
+            parts.append(" ".join(self.variables))
+
+        # If no variable has been defined, use *
+        else:
+            parts.append(" *")
+
+        # Add WHERE token
+        parts.append(f"\n{outer_indentation}WHERE ")
+
+    def _emit_tail(self, parts, indentation_depth):
+        """
+        Appends the text parts of the SPARQL select query after the WHERE pattern graph to a list.
+        :param parts: <list> The list of text parts to append to.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text.
+        """
+        # Most queries have neither group by expressions nor a limit
+        if not self.group_by and not self.limit:
+            return
+
+        outer_indentation = _indent(indentation_depth)
+
+        # Add group by expressions
+        for group in self.group_by:
+            parts.append(f"\n{outer_indentation}{group.get_text()}")
+
+        # Add limit if required
+        if self.limit:
+            parts.append(f"\nLIMIT {self.limit}")
 
 
 class SPARQLUpdateQuery(SPARQLQuery):
@@ -364,47 +738,348 @@ class SPARQLUpdateQuery(SPARQLQuery):
         """
         Generates the text for the SPARQL update query.
         :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
-        :return: <str> The SPARQL Update query text. Returns empty string if an exception was raised.
+        :return: <str> The SPARQL Update query text.
         """
+        parts = []
+        self._emit(parts, indentation_depth)
 
-        try:
-            # Calculate indentation
-            outer_indentation = indentation_depth * "   "
-
-            # Initialize text string
-            query_text = ""
-
-            # Add prefixes
-            for prefix in self.prefixes:
-                query_text += prefix.get_text()
+        return "".join(parts)
 
-            # If a delete graph pattern has been defined
-            if self.delete is not None:
-
-                # Add DELETE token
-                query_text += "\n%sDELETE " % (outer_indentation,)
-
-                # Add DELETE pattern graph
-                query_text += self.delete.get_text(indentation_depth=indentation_depth)[:-1]
-
-            # If an insert graph pattern has been defined
-            if self.insert is not None:
-                # Add INSERT token
-                query_text += "\n%sINSERT " % (outer_indentation,)
-
-                # Add INSERT pattern graph
-                query_text += self.insert.get_text(indentation_depth=indentation_depth)[:-1]
-
-            # If a where graph pattern has been defined
-            if self.where is not None:
-                # Add WHERE token
-                query_text += "\n%sWHERE " % (outer_indentation,)
-
-                # Add WHERE pattern graph
-                query_text += self.where.get_text(indentation_depth=indentation_depth)[:-1]
+    def write_to(self, stream, indentation_depth=0):
+        """
+        Writes the text for the SPARQL update query to a stream part by part, without generating the whole text first.
+        :param stream: <obj> A text stream (e.g. a file) or any other object with a write() method.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        """
+        parts = _StreamParts(stream)
+        self._emit(parts, indentation_depth)
+        parts.flush()
 
-            return query_text
+    def _emit(self, parts, indentation_depth=0):
+        """
+        Appends the text parts of the SPARQL update query to a list.
+        :param parts: <list> The list of text parts to append to.
+        :param indentation_depth: <int> A value that facilitates the appropriate addition of indents to the text. Defaults at 0.
+        """
+        # Calculate indentation
+        outer_indentation = _indent(indentation_depth)
+
+        # Add the prefixes block
+        parts.append(self._get_prefixes_text())
+
+        # If a delete graph pattern has been defined
+        if self.delete is not None:
+
+            # Add DELETE token and DELETE pattern graph
+            parts.append(f"\n{outer_indentation}DELETE ")
+            self.delete._emit(parts, indentation_depth, trailing_newline=False)
+
+        # If an insert graph pattern has been defined
+        if self.insert is not None:
+            # Add INSERT token and INSERT pattern graph
+            parts.append(f"\n{outer_indentation}INSERT ")
+            self.insert._emit(parts, indentation_depth, trailing_newline=False)
+
+        # If a where graph pattern has been defined
+        if self.where is not None:
+            # Add WHERE token and WHERE pattern graph
+            parts.append(f"\n{outer_indentation}WHERE ")
+            self.where._emit(parts, indentation_depth, trailing_newline=False)
+
+
+def _is_joined(entries, index):
+    """
+    Checks if a nested graph pattern is joined with the rest of the graph pattern holding it, instead of being an
+    operand of a UNION (i.e. being a UNION itself or being followed by one).
+    :param entries: <list> The entries of the graph pattern holding the nested one.
+    :param index: <int> The index of the nested graph pattern in the entries.
+    :return: <bool> True if the nested graph pattern is joined.
+    """
+    if entries[index]._is_union:
+        return False
+
+    next_index = index + 1
+    if next_index < len(entries):
+        next_entry = entries[next_index]
+        return not (type(next_entry) is SPARQLGraphPattern and next_entry._is_union)
+
+    return True
+
+
+def _fmt_triple(triple, inner_indentation, inner_depth, parts):
+    """
+    Appends the text for a Triple entry of a graph pattern to a list.
+    :param triple: <obj> The Triple object.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param inner_depth: <int> The indentation depth of the graph pattern contents.
+    :param parts: <list> The list of text parts to append to.
+    """
+    parts.append(f"{inner_indentation}{triple.get_text()}")
+
+
+# Number of triples joined into a single text part, which bounds the size of each write() of write_to()
+_TRIPLES_PER_PART = 256
+
+
+def _fmt_triples(triples, inner_indentation, parts):
+    """
+    Appends the text for the entries of a graph pattern that only holds triples to a list, in parts of at most
+    _TRIPLES_PER_PART triples.
+    :param triples: <list> The Triple objects.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param parts: <list> The list of text parts to append to.
+    """
+    # Each triple text ends with a newline, so joining with the indentation indents every following triple
+    for start in range(0, len(triples), _TRIPLES_PER_PART):
+        chunk = triples[start:start + _TRIPLES_PER_PART]
+        parts.append(inner_indentation + inner_indentation.join([triple.get_text() for triple in chunk]))
+
+
+def _fmt_nested_sel(select_query, inner_indentation, inner_depth, parts):
+    """
+    Appends the text for a SPARQLSelectQuery entry nested in a graph pattern to a list.
+    :param select_query: <obj> The nested SPARQLSelectQuery object.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param inner_depth: <int> The indentation depth of the graph pattern contents.
+    :param parts: <list> The list of text parts to append to.
+    """
+    parts.append(f"{inner_indentation}{{")
+    select_query._emit(parts, inner_depth + 1)
+    parts.append(f"{inner_indentation}}}\n")
+
+
+# Text generators for the entry types that a SPARQLGraphPattern may hold, besides nested graph patterns
+_ENTRY_HANDLERS = {
+    Triple: _fmt_triple,
+    SPARQLSelectQuery: _fmt_nested_sel
+}
+
+
+def _emit_open(graph_pattern, indentation_depth, parts):
+    """
+    Appends the opening text of a graph pattern (i.e. its opening brace and VALUES expressions) to a list.
+    :param graph_pattern: <obj> The SPARQLGraphPattern object.
+    :param indentation_depth: <int> The indentation depth of the graph pattern.
+    :param parts: <list> The list of text parts to append to.
+    """
+    inner_indentation = _indent(indentation_depth + 1)
+
+    # Reuse the opening text when the graph pattern is rendered at the same depth again
+    if graph_pattern._opening_depth == indentation_depth:
+        parts.append(graph_pattern._opening)
+    else:
+        parts.append(graph_pattern._get_opening(indentation_depth))
+
+    for value in graph_pattern.values:
+        parts.append(f"{inner_indentation}{value.get_text()}\n")
+
+
+def _emit_close(graph_pattern, indentation_depth, parts):
+    """
+    Appends the closing text of a graph pattern (i.e. its BIND and FILTER expressions and closing brace) to a list.
+    :param graph_pattern: <obj> The SPARQLGraphPattern object.
+    :param indentation_depth: <int> The indentation depth of the graph pattern.
+    :param parts: <list> The list of text parts to append to.
+    """
+    outer_indentation = _indent(indentation_depth)
+    inner_indentation = _indent(indentation_depth + 1)
+
+    for binding in graph_pattern.bindings:
+        parts.append(f"{inner_indentation}{binding.get_text()}\n")
+
+    for filter in graph_pattern.filters:
+        parts.append(f"{inner_indentation}{filter.get_text()}\n")
+
+    parts.append(f"{outer_indentation}}}\n")
+
+
+# Entry types that a graph pattern holding only triples has, for checking graph without a Python-level loop
+_TRIPLE_TYPES = frozenset((Triple,))
+
+
+def _walk_graph_pattern(graph_pattern, indentation_depth, parts, open_pattern, close_pattern, add_triples, handlers):
+    """
+    Walks a graph pattern and its entries in text order, calling the given functions to append their parts.
+    Nested graph patterns are walked with an explicit stack instead of recursive calls, so nesting depth is not
+    bound by the recursion limit.
+    :param graph_pattern: <obj> The SPARQLGraphPattern object.
+    :param indentation_depth: <int> The indentation depth of the graph pattern.
+    :param parts: <list> The list of parts to append to.
+    :param open_pattern: <function> Appends the opening parts of a graph pattern (e.g. _emit_open).
+    :param close_pattern: <function> Appends the closing parts of a graph pattern (e.g. _emit_close).
+    :param add_triples: <function> Appends the parts of all entries of a graph pattern that only holds triples.
+    :param handlers: <dict> The functions that append the parts of each entry type, besides nested graph patterns.
+    """
+    open_pattern(graph_pattern, indentation_depth, parts)
+
+    # Each stack item holds an open graph pattern, its depth and an iterator over its remaining entries
+    stack = [(graph_pattern, indentation_depth, iter(graph_pattern.graph))]
+
+    while stack:
+        current_pattern, depth, entries = stack[-1]
+        inner_depth = depth + 1
+        inner_indentation = _indent(inner_depth)
+
+        # Entries are only dispatched by type if there are other ones than triples, which is checked on every walk
+        # since graph may also be changed directly
+        if not _TRIPLE_TYPES.issuperset(map(type, current_pattern.graph)):
+            nested_pattern = None
+
+            for entry in entries:
+                if type(entry) is SPARQLGraphPattern:
+                    nested_pattern = entry.canonicalize() if entry._optimize else entry
+                    break
+
+                handler = handlers.get(type(entry))
+                if handler is not None:
+                    handler(entry, inner_indentation, inner_depth, parts)
+
+            # Open a nested graph pattern and resume the current one after it has been closed
+            if nested_pattern is not None:
+                open_pattern(nested_pattern, inner_depth, parts)
+                stack.append((nested_pattern, inner_depth, iter(nested_pattern.graph)))
+                continue
 
-        except Exception as e:
-            print("Error 1 @ SPARQLUpdateQuery.get_text()", e)
-            return ""
+        else:
+            add_triples(current_pattern.graph, inner_indentation, parts)
+
+        # All entries have been added, so the graph pattern can be closed
+        stack.pop()
+        close_pattern(current_pattern, depth, parts)
+
+
+def _compile_open(graph_pattern, indentation_depth, parts, values_call="{}.get_text()"):
+    """
+    Appends the opening parts of a graph pattern to a list of parts to be compiled.
+    :param graph_pattern: <obj> The SPARQLGraphPattern object.
+    :param indentation_depth: <int> The indentation depth of the graph pattern.
+    :param parts: <list> The list of parts to append to.
+    :param values_call: <str> The source code of the call that returns the text of a VALUES expression.
+    """
+    inner_indentation = _indent(indentation_depth + 1)
+
+    parts.append(graph_pattern._get_opening(indentation_depth))
+
+    for value in graph_pattern.values:
+        parts.extend((inner_indentation, (value, values_call), "\n"))
+
+
+def _compile_close(graph_pattern, indentation_depth, parts):
+    """
+    Appends the closing parts of a graph pattern to a list of parts to be compiled.
+    :param graph_pattern: <obj> The SPARQLGraphPattern object.
+    :param indentation_depth: <int> The indentation depth of the graph pattern.
+    :param parts: <list> The list of parts to append to.
+    """
+    outer_indentation = _indent(indentation_depth)
+    inner_indentation = _indent(indentation_depth + 1)
+
+    for binding in graph_pattern.bindings:
+        parts.extend((inner_indentation, (binding, "{}.get_text()"), "\n"))
+
+    for filter in graph_pattern.filters:
+        parts.extend((inner_indentation, (filter, "{}.get_text()"), "\n"))
+
+    parts.append(f"{outer_indentation}}}\n")
+
+
+def _compile_triple(triple, inner_indentation, inner_depth, parts):
+    """
+    Appends the parts of a Triple entry to a list of parts to be compiled.
+    :param triple: <obj> The Triple object.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param inner_depth: <int> The indentation depth of the graph pattern contents.
+    :param parts: <list> The list of parts to append to.
+    """
+    parts.extend((inner_indentation, (triple, "{}.get_text()")))
+
+
+def _compile_triples(triples, inner_indentation, parts):
+    """
+    Appends the parts of the entries of a graph pattern that only holds triples to a list of parts to be compiled.
+    :param triples: <list> The Triple objects.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param parts: <list> The list of parts to append to.
+    """
+    for triple in triples:
+        parts.extend((inner_indentation, (triple, "{}.get_text()")))
+
+
+def _compile_nested_sel(select_query, inner_indentation, inner_depth, parts):
+    """
+    Appends the parts of a SPARQLSelectQuery entry to a list of parts to be compiled.
+    :param select_query: <obj> The nested SPARQLSelectQuery object.
+    :param inner_indentation: <str> The indentation of the graph pattern contents.
+    :param inner_depth: <int> The indentation depth of the graph pattern contents.
+    :param parts: <list> The list of parts to append to.
+    """
+    parts.extend((
+        f"{inner_indentation}{{",
+        (select_query, f"{{}}.get_text(indentation_depth={inner_depth + 1})"),
+        f"{inner_indentation}}}\n"
+    ))
+
+
+# Part generators used by SPARQLGraphPattern.compile_renderer()
+_COMPILE_HANDLERS = {
+    Triple: _compile_triple,
+    SPARQLSelectQuery: _compile_nested_sel
+}
+
+
+def _values_text(value, values):
+    """
+    Generates the text for a VALUES expression in a function generated by SPARQLSelectQuery.compile().
+    :param value: <obj> The Values object.
+    :param values: <dict> The values to use instead, by VALUES variable name. None to use the values of the object.
+    :return: <str> The VALUES definition text.
+    """
+    if values is None or value.name not in values:
+        return value.get_text()
+
+    enclosed_values = " ".join([in_brackets(entry) for entry in values[value.name]])
+    return f"VALUES {value.name} {{{enclosed_values}}}"
+
+
+def _compile_parts(parts, arguments=""):
+    """
+    Generates a function that returns the text described by a list of parts.
+    :param parts: <list> The parts, given either as constant strings or as (object, call) tuples where call is the
+    source code of the call that returns the text of the object, with {} in place of the object (e.g. "{}.get_text()").
+    If object is None, call is used as is, so that it can refer to the function arguments.
+    :param arguments: <str> The source code of the function arguments (e.g. "end"). Defaults at no arguments.
+    :return: <function> A function that returns the joined text.
+    """
+    objects = []
+    items = []
+    constant = []
+
+    # Merge consecutive constant strings into a single literal
+    for part in parts:
+        if type(part) is str:
+            constant.append(part)
+        else:
+            if constant:
+                items.append(repr("".join(constant)))
+                constant = []
+            obj, call = part
+            if obj is None:
+                items.append(call)
+            else:
+                items.append(call.format(f"e[{len(objects)}]"))
+                objects.append(obj)
+
+    if constant:
+        items.append(repr("".join(constant)))
+
+    # Bind the terms through a closure, so that they cannot be replaced by an argument
+    source = (
+        f"def _make_render(e):\n"
+        f"    def _render({arguments}):\n"
+        f"        return \"\".join(({', '.join(items)},))\n"
+        f"    return _render\n"
+    )
+    namespace = {"_values_text": _values_text}
+    exec(compile(source, "<SPARQLBurger renderer>", "exec"), namespace)
+
+    return namespace["_make_render"](tuple(objects))
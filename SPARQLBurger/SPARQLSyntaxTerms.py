@@ -7,30 +7,67 @@ Created by Panos Mitzias (http://www.pmitzias.com)
 Powered by Catalink Ltd (http://catalink.eu)
 """
 
+import operator
 
+
+def _term_attribute(name, convert=None):
+    """
+    Creates a property for a syntax term attribute that is kept in the given slot and drops the cached text of the
+    term whenever it is set.
+    :param name: <str> The name of the slot (e.g. "_prefix").
+    :param convert: <function> A function applied to the values being set (e.g. tuple). Defaults at None.
+    :return: <obj> The property.
+    """
+    def set_attribute(term, value):
+        setattr(term, name, value if convert is None else convert(value))
+        term._cached = None
+
+    return property(operator.attrgetter(name), set_attribute)
+
+
+# Syntax terms cache their generated text on first use, and drop it whenever one of their attributes is set.
+# Nested objects (e.g. an IfClause in a Binding) may change on their own, so terms holding them are not cached.
+# Malformed arguments (e.g. a nested object without get_text()) raise an exception when the text is generated.
 class Prefix:
+    __slots__ = ("_prefix", "_namespace", "_cached")
+
+    prefix = _term_attribute("_prefix")
+    namespace = _term_attribute("_namespace")
+
     def __init__(self, prefix, namespace):
         """
         The Prefix class constructor.
         :param prefix: <str> The prefix (e.g. "ex").
         :param namespace: <str> The namespace (e.g. "http://www.example.com#").
         """
-        self.prefix = prefix
-        self.namespace = namespace
+        self._prefix = prefix
+        self._namespace = namespace
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given prefix (e.g. "PREFIX ex: <http://www.example.com#>")
-        :return: <str> The prefix definition text. Returns empty string if an exception was raised.
+        :return: <str> The prefix definition text.
         """
-        try:
-            return "PREFIX %s: <%s>\n" % (self.prefix, self.namespace)
-        except Exception as e:
-            print("Error 1 @ Prefix.get_text()")
-            return ""
+        if self._cached is None:
+            self._cached = f"PREFIX {self.prefix}: <{self.namespace}>\n"
+        return self._cached
+
+    def _emit(self, parts):
+        """
+        Appends the text of the prefix to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        parts.append(self.get_text())
 
 
 class Triple:
+    __slots__ = ("_subject", "_predicate", "_object", "_cached")
+
+    subject = _term_attribute("_subject")
+    predicate = _term_attribute("_predicate")
+    object = _term_attribute("_object")
+
     def __init__(self, subject, predicate, object):
         """
         The Triple class constructor.
@@ -38,61 +75,93 @@ class Triple:
         :param predicate: <str> The predicate string (e.g. "ex:hasName")
         :param object: <str> The object string (e.g. "\'John\'@en")
         """
-        self.subject = str(subject)
-        self.predicate = str(predicate)
-        self.object = str(object)
+        # Most arguments are already strings, so only convert the rest
+        self._subject = subject if type(subject) is str else str(subject)
+        self._predicate = predicate if type(predicate) is str else str(predicate)
+        self._object = object if type(object) is str else str(object)
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given triple.
-        :return: <str> The triple definition text. Returns empty string if an exception was raised.
+        :return: <str> The triple definition text.
         """
-        try:
-            return "%s %s %s . \n" % (self.subject, self.predicate, self.object)
-        except Exception as e:
-            print("Error 1 @ Triple.get_text()")
-            return ""
+        if self._cached is None:
+            self._cached = f"{self.subject} {self.predicate} {self.object} . \n"
+        return self._cached
+
+    def _emit(self, parts):
+        """
+        Appends the text of the triple to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        parts.append(self.get_text())
 
 
 class Filter:
+    __slots__ = ("_expression", "_cached")
+
+    expression = _term_attribute("_expression")
+
     def __init__(self, expression):
         """
         The Filter class constructor.
         :param expression: <str> The expression to get in the filter (e.g. "?age > 30")
         """
-        self.expression = expression
+        self._expression = expression
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given filter.
-        :return: <str> The filter definition text. Returns empty string if an exception was raised.
+        :return: <str> The filter definition text.
         """
-        try:
-            return "FILTER (%s)" % (self.expression,)
-        except Exception as e:
-            print("Error 1 @ Filter.get_text()")
-            return ""
+        if self._cached is None:
+            self._cached = f"FILTER ({self.expression})"
+        return self._cached
+
+    def _emit(self, parts):
+        """
+        Appends the text of the filter to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        parts.append(self.get_text())
 
 class Having:
+    __slots__ = ("_expression", "_cached")
+
+    expression = _term_attribute("_expression")
+
     def __init__(self, expression):
         """
         The Having class constructor.
         :param expression: <str> The expression to get in the having filter (e.g. "?age > 30")
         """
-        self.expression = expression
+        self._expression = expression
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given having filter.
-        :return: <str> The filter definition text. Returns empty string if an exception was raised.
+        :return: <str> The filter definition text.
+        """
+        if self._cached is None:
+            self._cached = f"HAVING ({self.expression})"
+        return self._cached
+
+    def _emit(self, parts):
+        """
+        Appends the text of the having filter to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
         """
-        try:
-            return "HAVING (%s)" % (self.expression,)
-        except Exception as e:
-            print("Error 1 @ Filter.get_text()")
-            return ""
+        parts.append(self.get_text())
 
 class Binding:
+    __slots__ = ("_value", "_variable", "_cached")
+
+    value = _term_attribute("_value")
+    variable = _term_attribute("_variable")
+
     def __init__(self, value, variable):
         """
         The Binding class constructor.
@@ -100,55 +169,93 @@ class Binding:
          OR <obj> Another object (e.g. IfClause) to be nested.
         :param variable: <str> The variable to be bound to this value (e.g. "?name")
         """
-        self.value = value
-        self.variable = variable
+        self._value = value
+        self._variable = variable
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given binding (e.g. "BIND('John' AS ?name)" or "BIND(IF(BOUND(...)) AS ?name") )
-        :return: <str> The binding definition text. Returns empty string if an exception was raised.
+        :return: <str> The binding definition text.
         """
-        try:
-            if type(self.value) is str:
-                value_text = self.value
-            else:
-                value_text = self.value.get_text()
+        if self._cached is not None:
+            return self._cached
 
-            return "BIND (%s AS %s)" % (value_text, self.variable)
+        parts = []
+        self._emit(parts)
 
-        except Exception as e:
-            print("Error 1 @ Binding.get_text()")
-            return ""
+        text = "".join(parts)
+
+        # Only terms made of plain strings have a fixed text that can be cached
+        if type(self._value) is str:
+            self._cached = text
+        return text
+
+    def _emit(self, parts):
+        """
+        Appends the text parts of the binding to a list, letting a nested object append its own parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        if self._cached is not None:
+            parts.append(self._cached)
+        else:
+            parts.append("BIND (")
+            _emit_nested(self.value, parts)
+            parts.append(f" AS {self.variable})")
 
 
 class Bound:
+    __slots__ = ("_variable", "_cached")
+
+    variable = _term_attribute("_variable")
+
     def __init__(self, variable):
         """
         The Bound class constructor.
         :param variable: <str> The variable to be checked if it is bound (e.g. "?name")
          OR <obj> Another object to be nested.
         """
-        self.variable = variable
+        self._variable = variable
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given BOUND clause (e.g. "BOUND (?name)" )
-        :return: <str> The bound definition text. Returns empty string if an exception was raised.
+        :return: <str> The bound definition text.
         """
-        try:
-            if type(self.variable) is str:
-                variable_text = self.variable
-            else:
-                variable_text = self.variable.get_text()
+        if self._cached is not None:
+            return self._cached
+
+        parts = []
+        self._emit(parts)
+
+        text = "".join(parts)
 
-            return "BOUND (%s)" % (variable_text, )
+        # Only terms made of plain strings have a fixed text that can be cached
+        if type(self._variable) is str:
+            self._cached = text
+        return text
 
-        except Exception as e:
-            print("Error 1 @ Bound.get_text()")
-            return ""
+    def _emit(self, parts):
+        """
+        Appends the text parts of the bound clause to a list, letting a nested object append its own parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        if self._cached is not None:
+            parts.append(self._cached)
+        else:
+            parts.append("BOUND (")
+            _emit_nested(self.variable, parts)
+            parts.append(")")
 
 
 class IfClause:
+    __slots__ = ("_condition", "_true_value", "_false_value", "_cached")
+
+    condition = _term_attribute("_condition")
+    true_value = _term_attribute("_true_value")
+    false_value = _term_attribute("_false_value")
+
     def __init__(self, condition, true_value, false_value):
         """
         The IfClause class constructor.
@@ -156,86 +263,128 @@ class IfClause:
         :param true_value: <str> The value for when IF condition is True OR <obj> Another object to be nested.
         :param false_value: <str> The value for when IF condition is False OR <obj> Another object to be nested.
         """
-        self.condition = condition
-        self.true_value = true_value
-        self.false_value = false_value
+        self._condition = condition
+        self._true_value = true_value
+        self._false_value = false_value
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given BOUND clause (e.g. "IF(?age > 18, 'adult', 'minor')" )
-        :return: <str> The if clause definition text. Returns empty string if an exception was raised.
+        :return: <str> The if clause definition text.
         """
-        try:
-            # Check for nested condition (e.g. a nested if condition)
-            if type(self.condition) is str:
-                condition_text = self.condition
-            else:
-                condition_text = self.condition.get_text()
+        if self._cached is not None:
+            return self._cached
 
-            # Check for nested value (e.g. a nested if value)
-            if type(self.true_value) is str:
-                true_value_text = self.true_value
-            else:
-                true_value_text = self.true_value.get_text()
+        parts = []
+        self._emit(parts)
 
-            # Check for nested value (e.g. a nested if value)
-            if type(self.false_value) is str:
-                false_value_text = self.false_value
-            else:
-                false_value_text = self.false_value.get_text()
+        text = "".join(parts)
 
-            return "IF (%s, %s, %s)" % (condition_text, true_value_text, false_value_text)
+        # Only terms made of plain strings have a fixed text that can be cached
+        if type(self._condition) is str and type(self._true_value) is str and type(self._false_value) is str:
+            self._cached = text
+        return text
 
-        except Exception as e:
-            print("Error 1 @ IfClause.get_text()")
-            return ""
+    def _emit(self, parts):
+        """
+        Appends the text parts of the if clause to a list, letting nested objects (e.g. a nested if condition) append
+        their own parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        if self._cached is not None:
+            parts.append(self._cached)
+        else:
+            parts.append("IF (")
+            _emit_nested(self.condition, parts)
+            parts.append(", ")
+            _emit_nested(self.true_value, parts)
+            parts.append(", ")
+            _emit_nested(self.false_value, parts)
+            parts.append(")")
 
 
 class GroupBy:
+    __slots__ = ("_variables", "_cached")
+
+    variables = _term_attribute("_variables", convert=tuple)
+
     def __init__(self, variables):
         """
         The GroupBy class constructor.
-        :param variables: <list> A list of variables as strings that will be used for the grouping
+        :param variables: <list> A list of variables as strings that will be used for the grouping.
+        The list is copied, so later changes to it do not affect the expression.
         """
-        self.variables = variables
+        self._variables = tuple(variables)
+        self._cached = None
 
     def get_text(self):
         """
         Generates the text for the given GROUP BY expression (e.g. "GROUP BY ?person ?age")
-        :return: <str> The GROUP BY definition text. Returns empty string if an exception was raised.
+        :return: <str> The GROUP BY definition text.
         """
-        try:
-            return "GROUP BY %s" % (" ".join(self.variables), )
+        if self._cached is None:
+            self._cached = f"GROUP BY {' '.join(self.variables)}"
+        return self._cached
 
-        except Exception as e:
-            print("Error 1 @ GroupBy.get_text()")
-            return ""
+    def _emit(self, parts):
+        """
+        Appends the text of the GROUP BY expression to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        parts.append(self.get_text())
 
 
 class Values:
+    __slots__ = ("_values", "_name", "_cached")
+
+    values = _term_attribute("_values", convert=tuple)
+    name = _term_attribute("_name")
+
     def __init__(self, values, name):
         """
         The Values class constructor.
         :param values: <list> A list of variables as strings that should be
                                 gathered under the same variable.
         :param name: <str> The name of the resulting variable.
+        The list of values is copied, so later changes to it do not affect the expression.
         """
-        self.values = values
-        self.name = name
+        self._values = tuple(values)
+        self._name = name
+        self._cached = None
 
     def get_text(self):
         """
         Generate the text for the given VALUES expression (e.g.
         "VALUES ?person {<"https://www.wikidata.org/entity/42">}
-        :return: <str> The VALUES defenition text. Returns empty string if an
-                        exception was raised.
+        :return: <str> The VALUES defenition text.
+        """
+        if self._cached is None:
+            # Same as in_brackets(), inlined to avoid a function call per value
+            enclosed_values = " ".join([f"<{value}>" if value.startswith("http") else value for value in self.values])
+            self._cached = f"VALUES {self.name} {{{enclosed_values}}}"
+        return self._cached
+
+    def _emit(self, parts):
         """
-        try:
-            enclosed_values = [in_brackets(value) for value in self.values]
-            return "VALUES %s {%s}" % (self.name, ' '.join(enclosed_values))
-        except Exception as e:
-            print("Error 1 @ Values.get_text()")
-            return ""
+        Appends the text of the VALUES expression to a list of text parts.
+        :param parts: <list> The list of text parts to append to.
+        """
+        parts.append(self.get_text())
+
+
+def _emit_nested(term, parts):
+    """
+    Appends the text of a term nested in another one to a list of text parts.
+    :param term: <str> A plain string OR <obj> A syntax term, or any other object with a get_text() method.
+    :param parts: <list> The list of text parts to append to.
+    """
+    if type(term) is str:
+        parts.append(term)
+    elif hasattr(term, "_emit"):
+        term._emit(parts)
+    else:
+        parts.append(term.get_text())
 
 
 def in_brackets(uri: str) -> str:
@@ -243,9 +392,8 @@ def in_brackets(uri: str) -> str:
     If the uri already has brackets, nothing happens.
     :returns: <str> A URI string enclosed in brackets.
     """
-    if uri.startswith("<"):
-        return uri
-    elif uri.startswith("http"):
-        return "<%s>" % uri
+    # A URI that already starts with "<" can never start with "http", so a single check is enough
+    if uri.startswith("http"):
+        return f"<{uri}>"
     else:
         return uri
@@ -1,9 +1,16 @@
+import io
+import pickle
 import re
+import weakref
+
+import pytest
 
 from SPARQLBurger.SPARQLQueryBuilder import SPARQLGraphPattern, SPARQLSelectQuery, SPARQLUpdateQuery
-from SPARQLBurger.SPARQLSyntaxTerms import Triple, Binding, IfClause, Filter, Bound, \
+from SPARQLBurger.SPARQLSyntaxTerms import Triple, Binding, IfClause, Filter, Having, Bound, \
     Prefix, GroupBy, Values
 
+_MULTISPACE = re.compile(r' {2,}')
+
 
 class TestSparqlQueryBuilder:
     def test_simple_pattern(self):
@@ -20,6 +27,28 @@ class TestSparqlQueryBuilder:
         assert generate_assert_string(pattern) == \
                "{\n ?person rdf:type ex:Person . \n ?person ex:hasName ?name . \n}\n"
 
+    def test_exact_indentation(self):
+        main_pattern = SPARQLGraphPattern()
+        main_pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person")
+            ]
+        )
+
+        optional_pattern = SPARQLGraphPattern(optional=True)
+        optional_pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="ex:hasAge", object="?age")
+            ]
+        )
+        optional_pattern.add_filter(filter=Filter(expression="?age > 18"))
+        main_pattern.add_nested_graph_pattern(optional_pattern)
+
+        # Runs of spaces only appear as indentation, so the text is compared as is
+        assert main_pattern.get_text() == \
+            "{\n   ?person rdf:type ex:Person . \n   OPTIONAL {\n      ?person ex:hasAge ?age . \n" \
+            "      FILTER (?age > 18)\n   }\n}\n"
+
     def test_optional_pattern(self):
         main_pattern = SPARQLGraphPattern()
         main_pattern.add_triples(
@@ -42,6 +71,120 @@ class TestSparqlQueryBuilder:
                "{\n ?person rdf:type ex:Person . \n ?person ex:hasName ?name . \n" \
                " OPTIONAL {\n ?person ex:hasAge ?age . \n }\n}\n"
 
+        # Changing the flag after rendering is reflected in the text
+        optional_pattern.is_optional = False
+        assert generate_assert_string(main_pattern) == \
+               "{\n ?person rdf:type ex:Person . \n ?person ex:hasName ?name . \n" \
+               " {\n ?person ex:hasAge ?age . \n }\n}\n"
+
+    def test_deduplicated_pattern(self):
+        pattern = SPARQLGraphPattern(dedupe=True)
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person"),
+                Triple(subject="?person", predicate="ex:hasName", object="?name")
+            ]
+        )
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person"),
+                Triple(subject="?person", predicate="ex:hasAge", object="?age")
+            ]
+        )
+
+        # Triples are compared as they are now, not as they were when added
+        pattern.graph[0].object = "ex:Employee"
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person"),
+                Triple(subject="?person", predicate="rdf:type", object="ex:Employee")
+            ]
+        )
+
+        # Repeated nested patterns are kept, since a UNION following them would otherwise change its operand
+        for union in (False, False, True):
+            nested_pattern = SPARQLGraphPattern(union=union)
+            nested_pattern.add_triples(
+                triples=[
+                    Triple(subject="?person", predicate="ex:hasEmail", object="?email")
+                ]
+            )
+            pattern.add_nested_graph_pattern(nested_pattern)
+
+        assert generate_assert_string(pattern) == \
+            "{\n ?person rdf:type ex:Employee . \n ?person ex:hasName ?name . \n ?person ex:hasAge ?age . \n" \
+            " ?person rdf:type ex:Person . \n {\n ?person ex:hasEmail ?email . \n }\n {\n ?person ex:hasEmail ?email . \n }\n" \
+            " UNION\n {\n ?person ex:hasEmail ?email . \n }\n}\n"
+
+    def test_optimized_pattern(self):
+        pattern = SPARQLGraphPattern(optimize=True)
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="ex:hasAge", object="?age")
+            ]
+        )
+        pattern.add_filter(filter=Filter(expression="?age > 18"))
+        pattern.add_having(filter=Having(expression="COUNT(?person) > 1"))
+        pattern.add_filter(filter=Filter(expression="?age < 65"))
+
+        # Add the same optional pattern twice
+        for _ in range(2):
+            optional_pattern = SPARQLGraphPattern(optional=True)
+            optional_pattern.add_triples(
+                triples=[
+                    Triple(subject="?person", predicate="ex:hasName", object="?name")
+                ]
+            )
+            pattern.add_nested_graph_pattern(optional_pattern)
+
+        assert generate_assert_string(pattern) == \
+            "{\n ?person ex:hasAge ?age . \n OPTIONAL {\n ?person ex:hasName ?name . \n }\n" \
+            " FILTER ((?age > 18) && (?age < 65))\n HAVING (COUNT(?person) > 1)\n}\n"
+
+        # The graph pattern itself is left unchanged
+        assert len(pattern.filters) == 3
+        assert len(pattern.graph) == 3
+
+        # Filters added to a nested graph pattern after rendering are merged too
+        shared_pattern = SPARQLGraphPattern(optional=True)
+        shared_pattern.add_filter(filter=Filter(expression="?age > 18"))
+        other_pattern = SPARQLGraphPattern()
+        other_pattern.add_nested_graph_pattern(shared_pattern)
+        pattern = SPARQLGraphPattern(optimize=True)
+        pattern.add_nested_graph_pattern(shared_pattern)
+        pattern.get_text()
+        shared_pattern.add_filter(filter=Filter(expression="?age < 65"))
+
+        assert generate_assert_string(pattern) == \
+            "{\n OPTIONAL {\n FILTER ((?age > 18) && (?age < 65))\n }\n}\n"
+        assert generate_assert_string(other_pattern) == \
+            "{\n OPTIONAL {\n FILTER (?age > 18)\n FILTER (?age < 65)\n }\n}\n"
+
+        # An optimized graph pattern is canonicalized when nested in one that is not optimized too
+        optimized_pattern = SPARQLGraphPattern(optional=True, optimize=True)
+        optimized_pattern.add_filter(filter=Filter(expression="?age > 18"))
+        optimized_pattern.add_filter(filter=Filter(expression="?age < 65"))
+        pattern = SPARQLGraphPattern()
+        pattern.add_nested_graph_pattern(optimized_pattern)
+
+        assert generate_assert_string(pattern) == \
+            "{\n OPTIONAL {\n FILTER ((?age > 18) && (?age < 65))\n }\n}\n"
+
+        # A repeated graph pattern is kept when either copy is an operand of a UNION
+        union_pattern = SPARQLGraphPattern(optimize=True)
+        for union in (False, False, True):
+            nested_pattern = SPARQLGraphPattern(union=union)
+            nested_pattern.add_triples(
+                triples=[
+                    Triple(subject="?person", predicate="rdf:type", object="ex:Person" if not union else "ex:Robot")
+                ]
+            )
+            union_pattern.add_nested_graph_pattern(nested_pattern)
+
+        assert generate_assert_string(union_pattern) == \
+            "{\n {\n ?person rdf:type ex:Person . \n }\n {\n ?person rdf:type ex:Person . \n }\n" \
+            " UNION\n {\n ?person rdf:type ex:Robot . \n }\n}\n"
+
     def test_binding_clause(self):
         main_pattern = SPARQLGraphPattern()
 
@@ -87,6 +230,13 @@ class TestSparqlQueryBuilder:
                "<https://www.wikidata.org/entity/108>}\n" \
                " ?person rdf:type ex:Person . \n ?person foaf:knows ?friend . \n}\n"
 
+        # The values are copied, so changing the list afterwards gives the same text
+        uris.append("https://www.wikidata.org/entity/64")
+        assert generate_assert_string(pattern) == \
+               "{\n VALUES ?friend {<https://www.wikidata.org/entity/42> " \
+               "<https://www.wikidata.org/entity/108>}\n" \
+               " ?person rdf:type ex:Person . \n ?person foaf:knows ?friend . \n}\n"
+
     def test_filter_bind_and_if_clauses(self):
         pattern = SPARQLGraphPattern()
         pattern.add_triples(
@@ -199,6 +349,55 @@ class TestSparqlQueryBuilder:
             "GROUP BY ?age\n" \
             "LIMIT 100"
 
+    def test_select_query_changes_after_rendering(self):
+        select_query = SPARQLSelectQuery()
+        select_query.add_prefix(
+            prefix=Prefix(prefix="ex", namespace="http://www.example.com#")
+        )
+        select_query.add_variables(variables=["?person"])
+        select_query.get_text()
+
+        # Prefixes and variables added after rendering are included in the next text
+        select_query.add_prefix(
+            prefix=Prefix(prefix="foaf", namespace="http://xmlns.com/foaf/0.1/")
+        )
+        select_query.add_variables(variables=["?age"])
+
+        assert generate_assert_string(select_query) == \
+            "PREFIX ex: <http://www.example.com#>\nPREFIX foaf: <http://xmlns.com/foaf/0.1/>\n\n" \
+            "SELECT ?person ?age\nWHERE "
+
+        # Prefixes are listed in order of prefix, regardless of the order they were added in
+        select_query.add_prefix(
+            prefix=Prefix(prefix="dc", namespace="http://purl.org/dc/elements/1.1/")
+        )
+
+        assert generate_assert_string(select_query) == \
+            "PREFIX dc: <http://purl.org/dc/elements/1.1/>\nPREFIX ex: <http://www.example.com#>\n" \
+            "PREFIX foaf: <http://xmlns.com/foaf/0.1/>\n\nSELECT ?person ?age\nWHERE "
+
+        # Changes made directly to the lists and prefixes are included as well
+        select_query.variables.append("?name")
+        select_query.prefixes.pop()
+        select_query.prefixes[0].namespace = "http://example.org/"
+
+        assert generate_assert_string(select_query) == \
+            "PREFIX ex: <http://example.org/>\nPREFIX foaf: <http://xmlns.com/foaf/0.1/>\n\n" \
+            "SELECT ?person ?age ?name\nWHERE "
+
+    def test_popular_prefixes_are_not_shared(self):
+        first_query = SPARQLSelectQuery(include_popular_prefixes=True)
+        second_query = SPARQLSelectQuery(include_popular_prefixes=True)
+        first_query.prefixes[0].namespace = "http://example.org/"
+
+        assert "PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>" in second_query.get_text()
+
+    def test_queries_keep_their_attribute_dict(self):
+        # Queries can still be weakly referenced and carry attributes of their own
+        for query in (SPARQLSelectQuery(), SPARQLUpdateQuery()):
+            assert weakref.ref(query)() is query
+            query.tag = 1
+
     def test_sparql_update_query(self):
         update_query = SPARQLUpdateQuery()
 
@@ -242,9 +441,177 @@ class TestSparqlQueryBuilder:
             "INSERT {\n ?person ex:hasAge 32 . \n}\n" \
             "WHERE {\n ?person rdf:type ex:Person . \n ?person ex:hasAge ?age . \n}"
 
+        # Writing to a stream gives the same text
+        stream = io.StringIO()
+        update_query.write_to(stream)
+        assert stream.getvalue() == update_query.get_text()
+
+    def test_large_pattern_written_in_parts(self):
+        pattern = SPARQLGraphPattern()
+        pattern.add_triples(
+            triples=[
+                Triple(subject=f"ex:person{i}", predicate="rdf:type", object="ex:Person") for i in range(1000)
+            ]
+        )
+
+        # The triples are written in several bounded parts instead of one large string
+        stream = RecordingStream()
+        pattern.write_to(stream)
+        assert "".join(stream.writes) == pattern.get_text()
+        assert len(stream.writes) > 4
+        assert max(len(text) for text in stream.writes) < 10000
+
+    def test_entries_added_to_graph_directly(self):
+        pattern = SPARQLGraphPattern()
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person")
+            ]
+        )
+        pattern.get_text()
+
+        optional_pattern = SPARQLGraphPattern(optional=True)
+        optional_pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="ex:hasAge", object="?age")
+            ]
+        )
+        pattern.graph.append(optional_pattern)
+
+        assert pattern.get_text() == \
+            "{\n   ?person rdf:type ex:Person . \n   OPTIONAL {\n      ?person ex:hasAge ?age . \n   }\n}\n"
+
+        # Replacing a triple in place is noticed as well
+        pattern.graph[0] = optional_pattern
+        assert pattern.get_text() == \
+            "{\n   OPTIONAL {\n      ?person ex:hasAge ?age . \n   }\n   OPTIONAL {\n      ?person ex:hasAge ?age . \n" \
+            "   }\n}\n"
+
+    def test_repeated_rendering(self):
+        triple = Triple(subject="?person", predicate="ex:hasAge", object="?age")
+        assert triple.get_text() is triple.get_text()
+
+        # A binding with a nested clause is rendered again on every call
+        binding = Binding(value=Bound(variable="?age"), variable="?has_age")
+        assert binding.get_text() == "BIND (BOUND (?age) AS ?has_age)"
+        binding.value = Bound(variable="?name")
+        assert binding.get_text() == "BIND (BOUND (?name) AS ?has_age)"
+
+        # Setting an attribute drops the cached text
+        binding.value = "?age"
+        assert binding.get_text() == "BIND (?age AS ?has_age)"
+        binding.value = "?years"
+        assert binding.get_text() == "BIND (?years AS ?has_age)"
+        triple.object = "?years"
+        assert triple.get_text() == "?person ex:hasAge ?years . \n"
+
+        values = Values(values=["ex:Alice"], name="?person")
+        assert values.get_text() == "VALUES ?person {ex:Alice}"
+        values.values = ["ex:Bob"]
+        assert values.values == ("ex:Bob",)
+        assert values.get_text() == "VALUES ?person {ex:Bob}"
+
+    def test_malformed_term_raises(self):
+        pattern = SPARQLGraphPattern()
+        pattern.add_binding(binding=Binding(value=42, variable="?answer"))
+
+        with pytest.raises(AttributeError):
+            pattern.get_text()
+
+    def test_deeply_nested_patterns(self):
+        main_pattern = SPARQLGraphPattern()
+        pattern = main_pattern
+
+        # Nest more patterns than the default recursion limit would allow
+        for _ in range(2000):
+            nested_pattern = SPARQLGraphPattern(optional=True)
+            pattern.add_nested_graph_pattern(nested_pattern)
+            pattern = nested_pattern
+        pattern.add_triples(triples=[Triple(subject="?s", predicate="?p", object="?o")])
+
+        text = generate_assert_string(main_pattern)
+        assert text.count("OPTIONAL {") == 2000
+        assert " ?s ?p ?o . \n" in text
+        assert text.endswith(" }\n" * 2000 + "}\n")
+
+        # Canonicalizing walks the nested patterns once too
+        optimized_pattern = SPARQLGraphPattern(optimize=True)
+        optimized_pattern.add_nested_graph_pattern(main_pattern)
+        assert optimized_pattern.get_text().count("OPTIONAL {") == 2000
+
+    def test_compiled_renderer(self):
+        pattern = SPARQLGraphPattern()
+        pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person")
+            ]
+        )
+        optional_pattern = SPARQLGraphPattern(optional=True)
+        optional_pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="ex:hasAge", object="?age")
+            ]
+        )
+        optional_pattern.add_filter(filter=Filter(expression="?age > 18"))
+        pattern.add_nested_graph_pattern(optional_pattern)
+
+        expected_text = pattern.get_text()
+        pattern.compile_renderer()
+        assert pattern.get_text() == expected_text
+
+        # Entries added to the lists directly drop the compiled renderer too
+        pattern.filters.append(Filter(expression="?age < 65"))
+        assert pattern.get_text().endswith("   FILTER (?age < 65)\n}\n")
+        pattern.filters.pop()
+        pattern.compile_renderer()
+
+        # A compiled pattern can still be pickled, without its renderer
+        assert pickle.loads(pickle.dumps(pattern)).get_text() == expected_text
+        with pytest.raises(TypeError):
+            pattern._render("\n", ())
+
+        # Adding an entry drops the compiled renderer
+        pattern.add_binding(binding=Binding(value="?age", variable="?years"))
+        assert generate_assert_string(pattern) == \
+            "{\n ?person rdf:type ex:Person . \n OPTIONAL {\n ?person ex:hasAge ?age . \n FILTER (?age > 18)\n }\n" \
+            " BIND (?age AS ?years)\n}\n"
+
+    def test_compiled_select_query(self):
+        select_query = SPARQLSelectQuery()
+        select_query.add_variables(variables=["?person"])
+        where_pattern = SPARQLGraphPattern()
+        where_pattern.add_value(value=Values(values=["ex:Alice"], name="?person"))
+        where_pattern.add_triples(
+            triples=[
+                Triple(subject="?person", predicate="rdf:type", object="ex:Person")
+            ]
+        )
+        select_query.set_where_pattern(graph_pattern=where_pattern)
+        select_query.add_group_by(group=GroupBy(variables=["?person"]))
+
+        render = select_query.compile()
+        assert render() == select_query.get_text()
+        assert render({"?other": ["ex:Carol"]}) == select_query.get_text()
+        with pytest.raises(TypeError):
+            render(None, ())
+
+        # The given values replace those of the matching VALUES expression
+        expected_text = select_query.get_text().replace("{ex:Alice}", "{ex:Bob <http://example.org/Carol>}")
+        assert render({"?person": ["ex:Bob", "http://example.org/Carol"]}) == expected_text
+
 
 def generate_assert_string(sparql_pattern) -> str:
     """ Returns the string representation of the given pattern.
         Shrinks any multi-space to a single space.
     """
-    return re.sub(r' {2,}', ' ', sparql_pattern.get_text())
+    text = sparql_pattern.get_text()
+    return _MULTISPACE.sub(' ', text) if '  ' in text else text
+
+
+class RecordingStream:
+    """ A stream that keeps the text of each write() call. """
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)